@@ -6,32 +6,82 @@
 
 import asyncio
 import aiohttp
+import atexit
+import orjson
 import logging
-from datetime import datetime
-from typing import Optional, Dict
-import json
+from datetime import datetime, date
+from typing import Optional, Dict, List, Tuple
 import os
-from pathlib import Path
+import queue
+import re
+import signal
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import lru_cache
+from logging.handlers import QueueHandler, QueueListener
 from aiohttp import web
-from glob import glob
+
+# Запись в файл и консоль идёт в отдельном потоке,
+# event loop только кладёт запись в очередь
+_log_queue = queue.SimpleQueue()
+_log_listener = QueueListener(
+    _log_queue,
+    logging.FileHandler('/var/log/freepbx-amocrm.log'),
+    logging.StreamHandler()
+)
+_log_listener.start()
+atexit.register(_log_listener.stop)
 
 logging.basicConfig(
     level=logging.INFO,
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('/var/log/freepbx-amocrm.log'),
-        logging.StreamHandler()
-    ]
+    handlers=[QueueHandler(_log_queue)]
 )
 logger = logging.getLogger(__name__)
 
+# Всё, кроме цифр - для нормализации номеров
+_NON_DIGIT = re.compile(r'\D+')
+
+# uniqueid в конце имени файла записи: ...-20261014-120000-<uniqueid>.wav;
+# uniqueid может содержать префикс systemname с дефисом (PBX1-1700000000.12),
+# поэтому берём всё после даты и времени, иначе - после последнего дефиса
+_RECORDING_UNIQUEID = re.compile(
+    r'(?:.*-\d{8}-\d{6}-|.*-)?(.+)\.(?:wav|mp3)', re.IGNORECASE
+)
+
+# Записи не больше этого размера загружаются из памяти, а не потоком
+_SMALL_RECORDING = 1 << 20
+
+# Готовое тело успешного ответа webhook
+_OK_BODY = orjson.dumps({"success": True})
+
+
+def _json_body(body: bytes):
+    """Разбор тела ответа; пустое тело (например, 204 No Content) - пустой dict"""
+    return orjson.loads(body) if body.strip() else {}
+
+
+@lru_cache(maxsize=4096)
+def _normalize_phone(callerid: str) -> Optional[str]:
+    """Номер из CallerID; один и тот же абонент повторяется в событиях AMI"""
+    phone = _NON_DIGIT.sub('', callerid)
+    
+    # Нормализация для РФ
+    if phone.startswith("8") and len(phone) == 11:
+        phone = "7" + phone[1:]
+    
+    # Минимум 10 цифр для валидного номера
+    return phone if len(phone) >= 10 else None
+
 
 class Config:
     """Загрузка конфигурации"""
     
     def __init__(self, config_path: str = "/opt/freepbx-amocrm/config.json"):
-        with open(config_path, 'r') as f:
-            self.data = json.load(f)
+        with open(config_path, 'rb') as f:
+            self.data = orjson.loads(f.read())
         logger.info(f"Конфигурация загружена из {config_path}")
     
     def get(self, *keys, default=None):
@@ -56,127 +106,324 @@ class AmoCRMAPI:
         self.client_id = config.get("amocrm", "client_id")
         self.client_secret = config.get("amocrm", "client_secret")
         self.redirect_uri = config.get("amocrm", "redirect_uri")
+        self._auth_url = (f"{self.base_url}/oauth?"
+                          f"client_id={self.client_id}&"
+                          f"redirect_uri={self.redirect_uri}&"
+                          f"mode=post_message&"
+                          f"state=amocrm_auth")
         self.access_token = None
         self.refresh_token = None
+        # Момент истечения access_token (time.time(), с запасом 5 минут);
+        # хранится в tokens.json, 0 - неизвестен
+        self.token_expires_at = 0.0
+        self._refresh_lock = asyncio.Lock()
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._refresh_loop_task: Optional[asyncio.Task] = None
         self.token_file = "/opt/freepbx-amocrm/tokens.json"
+        self.timeout = config.get("webhook", "timeout_seconds", default=15)
+        self._session: Optional[aiohttp.ClientSession] = None
+        # Размер пула соединений (все запросы идут на один хост AmoCRM)
+        self.pool_limit = int(config.get("webhook", "pool_limit", default=200))
+        self.pool_per_host = int(config.get("webhook", "pool_per_host", default=64))
+        # Ограничение одновременных запросов к API
+        self._semaphore = asyncio.Semaphore(int(config.get("amocrm", "max_concurrency", default=20)))
+        # Фоновая очередь загрузки записей
+        self.pending_uploads_file = "/opt/freepbx-amocrm/pending_uploads.json"
+        self._upload_queue: Optional[asyncio.Queue] = None
+        self._upload_workers = []
+        self._pending_lock = threading.Lock()
+        # Примечания всех контактов копятся до 500 мс (или до 20 штук)
+        # и отправляются одним запросом contacts/notes
+        self._note_buffer: List[Dict] = []
+        self._note_buffer_full = asyncio.Event()
+        self._flush_tasks = set()
+        # LRU-кеш поиска контактов: номер -> (истекает, контакт или None)
+        self._contact_cache: OrderedDict[str, Tuple[float, Optional[Dict]]] = OrderedDict()
+        
+    async def _session_get(self) -> aiohttp.ClientSession:
+        """Общая HTTP-сессия (keep-alive до AmoCRM), создаётся при первом обращении"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.pool_limit,
+                    limit_per_host=self.pool_per_host,
+                    keepalive_timeout=75,
+                    ttl_dns_cache=300,
+                    use_dns_cache=True,
+                    enable_cleanup_closed=True
+                ),
+                timeout=aiohttp.ClientTimeout(
+                    total=self.timeout,
+                    connect=5,
+                    sock_read=10
+                ),
+                json_serialize=lambda obj: orjson.dumps(obj).decode()
+            )
+        return self._session
+        
+    async def start(self):
+        """Запуск HTTP-сессии и фоновых задач"""
+        await self._session_get()
+        
+        self._upload_queue = asyncio.Queue(maxsize=256)
+        for item in self._load_pending_uploads():
+            self.enqueue_upload(*item)
+        self._upload_workers = [
+            asyncio.create_task(self._upload_worker())
+            for _ in range(4)
+        ]
+        self._refresh_loop_task = asyncio.create_task(self._refresh_loop())
+        
+    async def close(self):
+        """Остановка фоновых задач и закрытие HTTP-сессии"""
+        for task in (self._refresh_loop_task, self._refresh_task):
+            if task:
+                task.cancel()
+        self._refresh_loop_task = None
+        self._refresh_task = None
+        
+        for worker in self._upload_workers:
+            worker.cancel()
+        await asyncio.gather(*self._upload_workers, return_exceptions=True)
+        self._upload_workers = []
         
+        # Отправка ещё не ушедших примечаний
+        await asyncio.gather(*self._flush_tasks, return_exceptions=True)
+        
+        # Незагруженные записи сохраняем до следующего запуска
+        if self._upload_queue:
+            pending = []
+            while not self._upload_queue.empty():
+                pending.append(self._upload_queue.get_nowait())
+            self._save_pending_uploads(pending)
+        
+        if self._session:
+            await self._session.close()
+            self._session = None
+            
     async def load_tokens(self):
         """Загрузка токенов из файла"""
-        if os.path.exists(self.token_file):
-            with open(self.token_file, 'r') as f:
-                tokens = json.load(f)
-                self.access_token = tokens.get("access_token")
-                self.refresh_token = tokens.get("refresh_token")
-                logger.info("✓ Токены AmoCRM загружены")
+        tokens = await asyncio.to_thread(self._read_tokens)
+        if tokens:
+            self.access_token = tokens.get("access_token")
+            self.refresh_token = tokens.get("refresh_token")
+            self.token_expires_at = float(tokens.get("expires_at") or 0)
+            logger.info("✓ Токены AmoCRM загружены")
         else:
             logger.warning("⚠️  Токены не найдены, требуется авторизация")
                 
     async def save_tokens(self):
         """Сохранение токенов в файл"""
-        with open(self.token_file, 'w') as f:
-            json.dump({
-                "access_token": self.access_token,
-                "refresh_token": self.refresh_token,
-                "updated_at": datetime.now().isoformat()
-            }, f)
-        os.chmod(self.token_file, 0o600)
+        await asyncio.to_thread(self._write_tokens, {
+            "access_token": self.access_token,
+            "refresh_token": self.refresh_token,
+            "expires_at": self.token_expires_at,
+            "updated_at": datetime.now().isoformat()
+        })
         logger.info("✓ Токены сохранены")
         
-    async def get_auth_code_url(self):
+    def _read_tokens(self) -> Optional[Dict]:
+        """Чтение файла токенов (вызывается вне event loop)"""
+        if not os.path.exists(self.token_file):
+            return None
+        with open(self.token_file, 'rb') as f:
+            return orjson.loads(f.read())
+        
+    def _write_tokens(self, tokens: Dict):
+        """Запись файла токенов (вызывается вне event loop)"""
+        # Пишем во временный файл и атомарно подменяем, чтобы сбой
+        # посреди записи не оставил пустой tokens.json
+        tmp = self.token_file + ".tmp"
+        # Права 600 сразу при создании, без окна, когда токены доступны
+        # другим пользователям; fchmod - на случай, если .tmp остался
+        # от прошлого сбоя с другими правами (mode у open для него не действует)
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(fd, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(orjson.dumps(tokens))
+        os.replace(tmp, self.token_file)
+        
+    def get_auth_code_url(self):
         """Получение URL для авторизации"""
-        return (f"{self.base_url}/oauth?"
-                f"client_id={self.client_id}&"
-                f"redirect_uri={self.redirect_uri}&"
-                f"mode=post_message&"
-                f"state=amocrm_auth")
+        return self._auth_url
     
     async def exchange_code(self, code: str):
         """Обмен кода на токены"""
-        async with aiohttp.ClientSession() as session:
-            data = {
-                "client_id": self.client_id,
-                "client_secret": self.client_secret,
-                "grant_type": "authorization_code",
-                "code": code,
-                "redirect_uri": self.redirect_uri
-            }
-            
-            async with session.post(
-                f"{self.base_url}/oauth2/access_token",
-                json=data
-            ) as resp:
-                if resp.status != 200:
-                    text = await resp.text()
-                    raise Exception(f"Ошибка авторизации: {text}")
-                    
-                result = await resp.json()
-                self.access_token = result["access_token"]
-                self.refresh_token = result["refresh_token"]
-                await self.save_tokens()
-                logger.info("✓ Авторизация AmoCRM успешна")
+        data = {
+            "client_id": self.client_id,
+            "client_secret": self.client_secret,
+            "grant_type": "authorization_code",
+            "code": code,
+            "redirect_uri": self.redirect_uri
+        }
+        
+        session = await self._session_get()
+        async with session.post(
+            f"{self.base_url}/oauth2/access_token",
+            json=data
+        ) as resp:
+            if resp.status != 200:
+                text = await resp.text()
+                raise Exception(f"Ошибка авторизации: {text}")
                 
+            result = _json_body(await resp.read())
+            self.access_token = result["access_token"]
+            self.refresh_token = result["refresh_token"]
+            self.token_expires_at = time.time() + result.get("expires_in", 86400) - 300
+            await self.save_tokens()
+            logger.info("✓ Авторизация AmoCRM успешна")
+            
     async def refresh_tokens(self):
         """Обновление токенов"""
-        async with aiohttp.ClientSession() as session:
-            data = {
-                "client_id": self.client_id,
-                "client_secret": self.client_secret,
-                "grant_type": "refresh_token",
-                "refresh_token": self.refresh_token,
-                "redirect_uri": self.redirect_uri
-            }
-            
-            async with session.post(
-                f"{self.base_url}/oauth2/access_token",
-                json=data
-            ) as resp:
-                result = await resp.json()
-                self.access_token = result["access_token"]
-                self.refresh_token = result["refresh_token"]
-                await self.save_tokens()
-                logger.info("✓ Токены обновлены")
-                
-    async def api_request(self, method: str, endpoint: str, 
-                         data: Dict = None, retry: bool = True):
-        """Базовый API запрос с автообновлением токенов"""
-        headers = {
-            "Authorization": f"Bearer {self.access_token}",
-            "Content-Type": "application/json"
+        data = {
+            "client_id": self.client_id,
+            "client_secret": self.client_secret,
+            "grant_type": "refresh_token",
+            "refresh_token": self.refresh_token,
+            "redirect_uri": self.redirect_uri
         }
         
+        session = await self._session_get()
+        async with session.post(
+            f"{self.base_url}/oauth2/access_token",
+            json=data
+        ) as resp:
+            result = _json_body(await resp.read())
+            self.access_token = result["access_token"]
+            self.refresh_token = result["refresh_token"]
+            self.token_expires_at = time.time() + result.get("expires_in", 86400) - 300
+            await self.save_tokens()
+            logger.info("✓ Токены обновлены")
+            
+    async def _refresh_loop(self):
+        """Обновление токенов к моменту истечения, даже если запросов нет"""
+        while True:
+            await asyncio.sleep(max(60, self.token_expires_at - time.time()))
+            # Пока спали, токен могли обновить запросы - тогда ждём новый срок
+            if not self.refresh_token or time.time() < self.token_expires_at:
+                continue
+            await self._refresh_background(self.token_expires_at)
+            
+    async def _refresh_locked(self, expires_at: float):
+        """Обновление токенов, если их не обновили с момента expires_at"""
+        async with self._refresh_lock:
+            if self.token_expires_at == expires_at:
+                await self.refresh_tokens()
+            
+    async def _refresh_background(self, expires_at: float):
+        """Обновление токенов без ожидания вызывающей стороной"""
+        try:
+            await self._refresh_locked(expires_at)
+        except Exception as e:
+            logger.error(f"Ошибка обновления токенов: {e}")
+            
+    async def _ensure_token(self) -> float:
+        """Проверка срока access_token перед запросом"""
+        expires_at = self.token_expires_at
+        if not expires_at or not self.refresh_token:
+            return expires_at
+        
+        now = time.time()
+        if now > expires_at:
+            # Просрочен: запрос всё равно получит 401, обновляем сразу
+            await self._refresh_locked(expires_at)
+        elif now > expires_at - 180:
+            # Скоро истечёт: обновляем в фоне, запрос идёт со старым токеном
+            if self._refresh_task is None or self._refresh_task.done():
+                self._refresh_task = asyncio.create_task(
+                    self._refresh_background(expires_at)
+                )
+        return self.token_expires_at
+            
+    async def api_request(self, method: str, endpoint: str, 
+                         data: Dict = None, attempts: int = 3,
+                         params: Optional[Dict] = None):
+        """Базовый API запрос с автообновлением токенов и повтором при сбоях"""
+        return (await self._request(method, endpoint, data, attempts, params))[1]
+    
+    async def _request(self, method: str, endpoint: str,
+                       data: Dict = None, attempts: int = 3,
+                       params: Optional[Dict] = None) -> Tuple[Optional[int], Optional[Dict]]:
+        """Запрос к API; возвращает HTTP-статус и тело (None при ошибке)"""
         url = f"{self.base_url}/api/v4/{endpoint}"
+        headers = {"Content-Type": "application/json"}
+        refreshed = False
         
-        async with aiohttp.ClientSession() as session:
-            async with session.request(
-                method, url, headers=headers, json=data
-            ) as resp:
-                if resp.status == 401 and retry:
-                    logger.info("Токен устарел, обновляем...")
-                    await self.refresh_tokens()
-                    return await self.api_request(method, endpoint, data, False)
-                    
-                if resp.status >= 400:
-                    text = await resp.text()
-                    logger.error(f"API error {resp.status}: {text}")
-                    return None
-                    
-                return await resp.json()
+        for attempt in range(attempts):
+            last = attempt == attempts - 1
+            expires_at = await self._ensure_token()
+            # Заголовок обновляется на каждой попытке, чтобы подхватить новый токен
+            headers["Authorization"] = f"Bearer {self.access_token}"
+            
+            try:
+                async with self._semaphore:
+                    session = await self._session_get()
+                    async with session.request(
+                        method, url, headers=headers, json=data, params=params
+                    ) as resp:
+                        status = resp.status
+                        if status < 400:
+                            return status, _json_body(await resp.read())
+                        text = await resp.text()
+            except aiohttp.ClientConnectorError as e:
+                if last:
+                    raise
+                status, text = None, f"Ошибка соединения: {e}"
+            
+            if status == 401 and not refreshed and not last:
+                # Токен обновляем вне семафора, чтобы не занимать слот
+                logger.info("Токен устарел, обновляем...")
+                refreshed = True
+                await self._refresh_locked(expires_at)
+                continue
+            # 5xx повторяем только для GET: POST мог быть уже выполнен
+            # (шлюз ответил по таймауту), повтор создаст дубли примечаний;
+            # при ошибке соединения запрос не ушёл, его повторяем всегда
+            retryable = status is None or (status >= 500 and method == "GET")
+            if retryable and not last:
+                delay = 2 ** attempt * 0.1
+                logger.warning(f"⚠️  Сбой запроса {endpoint} ({status or text}), повтор через {delay:.1f} с")
+                await asyncio.sleep(delay)
+                continue
+            
+            logger.error(f"API error {status}: {text}")
+            return status, None
     
     async def find_contact(self, phone: str) -> Optional[Dict]:
         """Поиск контакта по телефону"""
-        phone_clean = ''.join(filter(str.isdigit, phone))
+        phone_clean = _NON_DIGIT.sub('', phone)
+        
+        cached = self._contact_cache.get(phone_clean)
+        if cached and cached[0] > time.monotonic():
+            self._contact_cache.move_to_end(phone_clean)
+            logger.debug(f"Контакт {phone_clean} взят из кеша")
+            return cached[1]
         
         logger.debug(f"Поиск контакта: {phone_clean}")
-        result = await self.api_request("GET", f"contacts?query={phone_clean}")
+        result = await self.api_request(
+            "GET", "contacts", params={"query": phone_clean}
+        )
         
         if result and result.get("_embedded", {}).get("contacts"):
             contact = result["_embedded"]["contacts"][0]
             logger.info(f"✓ Контакт найден: ID={contact['id']}, Имя={contact.get('name', 'N/A')}")
+            self._cache_contact(phone_clean, contact, 300)
             return contact
         
         logger.info(f"❌ Контакт с номером {phone_clean} не найден")
+        if result is not None:
+            # Короткий срок, чтобы новый контакт быстро стал виден
+            self._cache_contact(phone_clean, None, 30)
         return None
     
+    def _cache_contact(self, phone_clean: str, contact: Optional[Dict], ttl: float):
+        """Сохранение результата поиска контакта в кеш"""
+        self._contact_cache[phone_clean] = (time.monotonic() + ttl, contact)
+        self._contact_cache.move_to_end(phone_clean)
+        if len(self._contact_cache) > 10_000:
+            # Вытесняем самый давно использованный номер
+            self._contact_cache.popitem(last=False)
+    
     async def create_unsorted(self, phone: str):
         """Создание неразобранного"""
         data = [{
@@ -197,10 +444,10 @@ class AmoCRMAPI:
         result = await self.api_request("POST", "leads/unsorted/forms", data)
         if result:
             logger.info(f"✓ Неразобранное создано для {phone}")
+            self._contact_cache.pop(_NON_DIGIT.sub('', phone), None)
         return result
     
-    async def add_call_to_contact(self, contact_id: int, phone: str, 
-                                  call_data: Dict, recording_path: str = None):
+    async def add_call_to_contact(self, contact_id: int, phone: str, call_data: Dict):
         """Добавление звонка к контакту"""
         # Определение типа звонка
         if call_data["direction"] == "inbound":
@@ -224,48 +471,209 @@ class AmoCRMAPI:
             }
         }
         
-        result = await self.api_request(
-            "POST", 
-            f"contacts/{contact_id}/notes",
-            [call_note]
-        )
+        self._queue_note(call_note)
+    
+    def _queue_note(self, note: Dict):
+        """Добавление примечания в пакет; ошибки отправки логируются при сбросе"""
+        # Первое примечание в пустом буфере запускает отложенную отправку
+        if not self._note_buffer:
+            task = asyncio.create_task(self._flush_notes())
+            self._flush_tasks.add(task)
+            task.add_done_callback(self._flush_tasks.discard)
+        self._note_buffer.append(note)
+        if len(self._note_buffer) >= 20:
+            self._note_buffer_full.set()
+    
+    async def _flush_notes(self):
+        """Отправка накопленных примечаний по таймауту или заполнению пакета"""
+        try:
+            await asyncio.wait_for(self._note_buffer_full.wait(), 0.5)
+        except asyncio.TimeoutError:
+            pass
+        self._note_buffer_full.clear()
+        buffer, self._note_buffer = self._note_buffer, []
+        # Пока ждали, пакет мог перерасти предел - делим по 20
+        await asyncio.gather(*(
+            self._send_notes(buffer[i:i + 20])
+            for i in range(0, len(buffer), 20)
+        ))
+    
+    async def _send_notes(self, notes: List[Dict]):
+        """Один запрос с примечаниями разных контактов"""
+        try:
+            # entity_id у каждого примечания - один запрос на все контакты
+            status, result = await self._request("POST", "contacts/notes", notes)
+        except Exception as e:
+            status, result = None, None
+            logger.error(f"Ошибка отправки примечаний: {e}")
         
-        # Загрузка записи (если есть)
-        if recording_path and os.path.exists(recording_path):
-            await self.upload_recording(contact_id, recording_path)
-            
-        return result
+        if result is not None:
+            for note in notes:
+                logger.info(f"✓ Звонок добавлен к контакту {note['entity_id']}")
+            return
+        # Весь пакет отклоняется с 4xx из-за одного примечания (например,
+        # контакт из кеша уже удалён) - делим пакет пополам и отправляем
+        # части отдельно, чтобы потерять только это примечание
+        rejected = status is not None and 400 <= status < 500 and status not in (401, 429)
+        if rejected and len(notes) > 1:
+            half = len(notes) // 2
+            await asyncio.gather(
+                self._send_notes(notes[:half]),
+                self._send_notes(notes[half:])
+            )
+            return
+        for note in notes:
+            logger.error(f"❌ Примечание о звонке не добавлено к контакту {note['entity_id']}")
     
-    async def upload_recording(self, contact_id: int, file_path: str):
-        """Загрузка записи разговора"""
+    def enqueue_upload(self, contact_id: int, file_path: str):
+        """Постановка записи в очередь на загрузку"""
+        item = (contact_id, file_path)
         try:
-            with open(file_path, 'rb') as f:
-                file_content = f.read()
-                file_name = os.path.basename(file_path)
-                
-                form = aiohttp.FormData()
-                form.add_field('file', file_content, 
-                             filename=file_name,
-                             content_type='audio/wav')
-                
-                headers = {
-                    "Authorization": f"Bearer {self.access_token}"
-                }
-                
-                async with aiohttp.ClientSession() as session:
-                    async with session.post(
-                        f"{self.base_url}/api/v4/contacts/{contact_id}/files",
-                        headers=headers,
-                        data=form
-                    ) as resp:
-                        if resp.status == 200:
-                            logger.info(f"🎙️  Запись загружена: {file_name}")
-                        else:
-                            text = await resp.text()
-                            logger.error(f"Ошибка загрузки записи: {text}")
-                            
+            self._upload_queue.put_nowait(item)
+        except asyncio.QueueFull:
+            logger.warning(f"Очередь загрузки переполнена, запись отложена: {file_path}")
+            # Запись на диск - в потоке, не блокируя event loop
+            asyncio.get_running_loop().run_in_executor(
+                None, self._save_pending_uploads, [item]
+            )
+    
+    async def _upload_worker(self):
+        """Фоновый загрузчик записей"""
+        while True:
+            item = await self._upload_queue.get()
+            try:
+                if not await self.upload_recording(*item):
+                    await asyncio.to_thread(self._save_pending_uploads, [item])
+            except asyncio.CancelledError:
+                self._save_pending_uploads([item])
+                raise
+            except Exception as e:
+                # Воркер не должен завершаться из-за одной записи
+                logger.error(f"Ошибка загрузки записи {item}: {e}")
+                await asyncio.to_thread(self._save_pending_uploads, [item])
+            finally:
+                self._upload_queue.task_done()
+    
+    def _load_pending_uploads(self) -> list:
+        """Чтение отложенных загрузок, оставшихся с прошлого запуска"""
+        with self._pending_lock:
+            if not os.path.exists(self.pending_uploads_file):
+                return []
+            try:
+                with open(self.pending_uploads_file, 'rb') as f:
+                    lines = f.read().splitlines()
+                os.remove(self.pending_uploads_file)
+            except OSError as e:
+                logger.error(f"Ошибка чтения отложенных загрузок: {e}")
+                return []
+        
+        items = []
+        for line in lines:
+            try:
+                value = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                continue
+            # Старый формат - весь список одной строкой
+            if isinstance(value, list) and value and isinstance(value[0], list):
+                items.extend(value)
+            else:
+                items.append(value)
+        
+        # Формат элемента: [contact_id, file_path]; лишние поля от старых
+        # версий отбрасываем, битые элементы пропускаем
+        return [
+            (item[0], item[1]) for item in items
+            if isinstance(item, list) and len(item) >= 2
+            and isinstance(item[0], int) and isinstance(item[1], str)
+            and os.path.exists(item[1])
+        ]
+    
+    def _save_pending_uploads(self, items: list):
+        """Сохранение отложенных загрузок на диск (по одной на строку)"""
+        if not items:
+            return
+        data = b"".join(orjson.dumps(list(item)) + b"\n" for item in items)
+        try:
+            # Дописываем под блокировкой: воркеры (в потоках), переполненная
+            # очередь и остановка сервиса могут сохранять одновременно
+            with self._pending_lock:
+                with open(self.pending_uploads_file, 'ab') as f:
+                    f.write(data)
+            logger.info(f"Отложено загрузок записей: {len(items)}")
         except Exception as e:
-            logger.error(f"Ошибка при загрузке записи: {e}")
+            logger.error(f"Ошибка сохранения отложенных загрузок: {e}")
+    
+    async def upload_recording(self, contact_id: int, file_path: str) -> bool:
+        """Загрузка записи с повторами; False - если все 3 попытки неудачны"""
+        refreshed = False
+        for attempt in range(3):
+            try:
+                expires_at = await self._ensure_token()
+                if await self._do_upload(contact_id, file_path):
+                    return True
+                # 401: токен обновляем один раз и повторяем без паузы;
+                # повторный 401 или 401 на последней попытке - откладываем
+                if refreshed or attempt == 2:
+                    return False
+                refreshed = True
+                await self._refresh_locked(expires_at)
+                continue
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning(f"Ошибка загрузки записи (попытка {attempt + 1}): {e}")
+                if attempt < 2:
+                    await asyncio.sleep(2 ** attempt)
+            except OSError as e:
+                # Повтор не поможет (например, файл удалён); прочие ошибки
+                # уходят в воркер, и запись откладывается
+                logger.error(f"Ошибка при загрузке записи: {e}")
+                return True
+        return False
+    
+    async def _do_upload(self, contact_id: int, file_path: str) -> bool:
+        """Загрузка записи разговора; False - токен отклонён (401)"""
+        # Открытие файла вне event loop
+        f = await asyncio.to_thread(open, file_path, 'rb')
+        try:
+            file_name = os.path.basename(file_path)
+            
+            # Запись до 1 МБ читаем одним вызовом в потоке; большие aiohttp
+            # отправляет частями прямо из файла, не держа их в памяти
+            if os.fstat(f.fileno()).st_size <= _SMALL_RECORDING:
+                body = await asyncio.to_thread(f.read)
+            else:
+                body = f
+            
+            form = aiohttp.FormData()
+            form.add_field('file', body, 
+                         filename=file_name,
+                         content_type='audio/wav')
+            
+            headers = {
+                "Authorization": f"Bearer {self.access_token}"
+            }
+            
+            session = await self._session_get()
+            async with session.post(
+                f"{self.base_url}/api/v4/contacts/{contact_id}/files",
+                headers=headers,
+                data=form,
+                # Файл идёт потоком, поэтому ограничиваем не весь запрос,
+                # а простой соединения: длинная запись не обрывается по таймауту
+                timeout=aiohttp.ClientTimeout(total=None, connect=5, sock_read=60)
+            ) as resp:
+                if resp.status >= 500:
+                    resp.raise_for_status()
+                if resp.status == 401:
+                    logger.warning("Токен отклонён при загрузке записи")
+                    return False
+                if resp.status == 200:
+                    logger.info(f"🎙️  Запись загружена: {file_name}")
+                else:
+                    text = await resp.text()
+                    logger.error(f"Ошибка загрузки записи: {text}")
+                return True
+        finally:
+            f.close()
 
 
 class CallProcessor:
@@ -275,6 +683,78 @@ class CallProcessor:
         self.config = config
         self.amocrm = amocrm
         self.recordings_dir = "/var/spool/asterisk/monitor"
+        # uniqueid -> путь к записи, пополняется наблюдателем каталога
+        self._recording_index: Dict[str, str] = {}
+        self._observer = None
+        
+    def start_watch(self):
+        """Запуск наблюдения за каталогом записей (если установлен watchdog)"""
+        try:
+            from watchdog.observers import Observer
+            from watchdog.events import FileSystemEventHandler
+        except ImportError:
+            logger.info("watchdog не установлен, записи ищутся сканированием каталога")
+            return
+        
+        loop = asyncio.get_running_loop()
+        index_recording = self._index_recording
+        
+        class RecordingHandler(FileSystemEventHandler):
+            # Вызывается из потока watchdog - передаём путь в event loop
+            def on_created(self, event):
+                if not event.is_directory:
+                    loop.call_soon_threadsafe(index_recording, event.src_path)
+            
+            def on_moved(self, event):
+                if not event.is_directory:
+                    loop.call_soon_threadsafe(index_recording, event.dest_path)
+        
+        observer = Observer()
+        try:
+            observer.schedule(RecordingHandler(), self.recordings_dir, recursive=True)
+            observer.start()
+        except OSError as e:
+            logger.warning(f"Наблюдение за {self.recordings_dir} недоступно: {e}")
+            return
+        self._observer = observer
+        
+        # Записи, появившиеся до запуска
+        try:
+            with os.scandir(f"{self.recordings_dir}/{date.today():%Y/%m/%d}") as it:
+                for e in it:
+                    self._index_recording(e.path)
+        except FileNotFoundError:
+            pass
+        logger.info("👁️  Наблюдение за каталогом записей запущено")
+        
+    async def stop_watch(self):
+        """Остановка наблюдения за каталогом записей"""
+        if self._observer:
+            self._observer.stop()
+            await asyncio.to_thread(self._observer.join)
+            self._observer = None
+        
+    def _index_recording(self, path: str):
+        """Добавление файла записи в индекс"""
+        m = _RECORDING_UNIQUEID.fullmatch(os.path.basename(path))
+        if not m:
+            return
+        uniqueid = m.group(1).lower()
+        # Переставляем в конец, чтобы вытеснять самые старые записи
+        self._recording_index.pop(uniqueid, None)
+        self._recording_index[uniqueid] = path
+        if len(self._recording_index) > 10_000:
+            del self._recording_index[next(iter(self._recording_index))]
+        
+    async def _wait_recording(self, uniqueid: str) -> Optional[str]:
+        """Запись из индекса; ждём до 2.5 с, если файл ещё не создан"""
+        uniqueid = uniqueid.lower()
+        for _ in range(5):
+            path = self._recording_index.get(uniqueid)
+            if path:
+                return path
+            await asyncio.sleep(0.5)
+        return None
         
     async def process_call(self, call_data: Dict):
         """Обработка завершённого звонка"""
@@ -294,39 +774,62 @@ class CallProcessor:
             await self.amocrm.create_unsorted(phone)
             return
         
-        # Поиск записи
-        recording_path = self.find_recording(call_data["uniqueid"])
+        # Добавление звонка; примечание уходит в AmoCRM пакетом,
+        # результат отправки логируется в _send_notes
+        await self.amocrm.add_call_to_contact(contact["id"], phone, call_data)
         
-        if recording_path:
+        # Поиск записи и загрузка (если есть) - в фоне
+        try:
+            recording_path = await self._locate_recording(call_data)
+        except Exception as e:
+            logger.error(f"Ошибка поиска записи: {e}")
+            recording_path = None
+        if recording_path and os.path.exists(recording_path):
             logger.info(f"🎙️  Найдена запись: {recording_path}")
+            self.amocrm.enqueue_upload(contact["id"], recording_path)
         
-        # Добавление звонка
-        result = await self.amocrm.add_call_to_contact(
-            contact["id"],
-            phone,
-            call_data,
-            recording_path
-        )
+    async def _locate_recording(self, call_data: Dict) -> Optional[str]:
+        """Запись из индекса наблюдателя или сканированием каталога"""
+        if self._observer:
+            # У неотвеченного звонка записи нет - не ждём её 2.5 с
+            if call_data.get("status") != "ANSWERED":
+                return self._recording_index.get(call_data["uniqueid"].lower())
+            return await self._wait_recording(call_data["uniqueid"])
         
-        if result:
-            logger.info(f"✓ Звонок добавлен к контакту {contact['id']}")
-        else:
-            logger.error(f"❌ Ошибка добавления звонка")
+        timestamp = call_data.get("timestamp")
+        start_time = datetime.fromisoformat(timestamp) if timestamp else datetime.now()
+        return await asyncio.to_thread(
+            self.find_recording, call_data["uniqueid"], start_time
+        )
         
-    def find_recording(self, uniqueid: str) -> Optional[str]:
+    def find_recording(self, uniqueid: str, start_time: datetime) -> Optional[str]:
         """Поиск файла записи"""
-        patterns = [
-            f"{self.recordings_dir}/**/*{uniqueid}*.wav",
-            f"{self.recordings_dir}/**/*{uniqueid}*.WAV",
-            f"{self.recordings_dir}/**/*{uniqueid}*.mp3"
-        ]
+        # FreePBX сохраняет записи в формате:
+        # /var/spool/asterisk/monitor/YYYY/MM/DD/
+        # Промахи не кешируем: каждый uniqueid ищется один раз за звонок,
+        # а метод выполняется в нескольких потоках сразу
         
-        for pattern in patterns:
-            files = glob(pattern, recursive=True)
-            if files:
-                return max(files, key=os.path.getmtime)
+        # Имя файла заканчивается на -<uniqueid>.<ext>; проверка суффикса
+        # не путает 1700000000.1 с 1700000000.12
+        uid = uniqueid.lower()
+        suffixes = (f"-{uid}.wav", f"-{uid}.mp3")
+        entries = []
+        # Звонок мог перейти через полночь
+        for day in {start_time.date(), date.today()}:
+            try:
+                with os.scandir(f"{self.recordings_dir}/{day:%Y/%m/%d}") as it:
+                    entries.extend(
+                        e for e in it
+                        if e.name.lower().endswith(suffixes)
+                    )
+            except FileNotFoundError:
+                continue
         
-        return None
+        if not entries:
+            return None
+        
+        # Возвращаем самый свежий файл
+        return max(entries, key=lambda e: e.stat().st_mtime).path
 
 
 class WebhookServer:
@@ -336,6 +839,9 @@ class WebhookServer:
         self.config = config
         self.amocrm = amocrm
         self.processor = processor
+        # Момент запуска для health check - форматируется один раз
+        self._started_at = datetime.now().isoformat()
+        self._started_mono = time.monotonic()
         self.app = web.Application()
         self.setup_routes()
         
@@ -353,7 +859,7 @@ class WebhookServer:
         if not code:
             return web.json_response({
                 "error": "No code provided",
-                "auth_url": await self.amocrm.get_auth_code_url()
+                "auth_url": self.amocrm.get_auth_code_url()
             }, status=400)
         
         try:
@@ -369,9 +875,9 @@ class WebhookServer:
     async def handle_call_webhook(self, request):
         """Webhook для звонков"""
         try:
-            data = await request.json()
+            data = orjson.loads(await request.read())
             await self.processor.process_call(data)
-            return web.json_response({"success": True})
+            return web.Response(body=_OK_BODY, content_type="application/json")
         except Exception as e:
             logger.error(f"Webhook error: {e}")
             return web.json_response({"error": str(e)}, status=500)
@@ -379,24 +885,26 @@ class WebhookServer:
     async def handle_health(self, request):
         """Health check"""
         amocrm_status = "ok" if self.amocrm.access_token else "no_token"
-        return web.json_response({
+        return web.Response(body=orjson.dumps({
             "status": "ok",
             "amocrm": amocrm_status,
-            "timestamp": datetime.now().isoformat()
-        })
+            "started_at": self._started_at,
+            "uptime": int(time.monotonic() - self._started_mono)
+        }), content_type="application/json")
     
     async def handle_test_call(self, request):
         """🧪 ТЕСТОВЫЙ ENDPOINT"""
         try:
             test_phone = self.config.get("debug", "test_phone") or "79991234567"
+            now = time.time()
             
             call_data = {
                 "phone": test_phone,
                 "direction": "inbound",
                 "duration": 42,
                 "status": "ANSWERED",
-                "uniqueid": f"test_{int(datetime.now().timestamp())}",
-                "timestamp": datetime.now().isoformat(),
+                "uniqueid": f"test_{int(now)}",
+                "timestamp": datetime.fromtimestamp(now).isoformat(),
                 "internal_call": False
             }
             
@@ -423,13 +931,45 @@ class WebhookServer:
         logger.info(f"   - Test call: http://{host}:{port}/test-call")
 
 
+@dataclass(slots=True)
+class ActiveCall:
+    """Активный канал AMI"""
+    channel: str
+    callerid: str
+    exten: str
+    context: str
+    start_time: float  # time.time() - для timestamp в call_data
+    start_mono: float  # time.monotonic() - для расчёта длительности
+    direction: str
+    is_internal: bool  # короткий CallerID - внутренний номер
+    connected: bool = False
+    answer_mono: Optional[float] = None
+
+
 class AsteriskAMIHandler:
     """Обработчик Asterisk AMI"""
     
+    # Входящие: from-trunk/from-pstn, исходящие: from-internal,
+    # внутренние: ext-local (учитывается только в контексте)
+    _DIR_RE = re.compile(
+        r'(?P<inbound>from-trunk|from-pstn)|(?P<outbound>from-internal)'
+        r'|(?P<internal>ext-local)',
+        re.IGNORECASE
+    )
+    
     def __init__(self, config: Config, processor: CallProcessor):
         self.config = config
         self.processor = processor
-        self.active_channels = {}
+        self.active_channels: Dict[str, ActiveCall] = {}
+        # Завершённые звонки обрабатывает фиксированный пул задач
+        self._call_queue: asyncio.Queue = asyncio.Queue(maxsize=1000)
+        self._workers_count = int(config.get("webhook", "workers", default=32))
+        self._workers = []
+        self._sweep_task: Optional[asyncio.Task] = None
+        # Настройки отладки читаются один раз, а не на каждое событие
+        self._detailed_logging = bool(config.get("debug", "detailed_ami_logging"))
+        self._process_internal = bool(config.get("debug", "process_internal_calls"))
+        self._test_phone = config.get("debug", "test_phone")
         
     async def connect(self):
         """Подключение к AMI"""
@@ -452,6 +992,54 @@ class AsteriskAMIHandler:
         self.manager.register_event("Hangup", self.on_hangup)
         self.manager.register_event("BridgeEnter", self.on_bridge_enter)
         
+        self._start_workers()
+        if self._sweep_task is None:
+            self._sweep_task = asyncio.create_task(self._sweep())
+        
+    async def close(self):
+        """Остановка обработчиков звонков (до закрытия AmoCRMAPI)"""
+        # Иначе process_call мог бы поставить запись в уже сохранённую
+        # очередь загрузок или открыть новую HTTP-сессию после close()
+        tasks = self._workers + ([self._sweep_task] if self._sweep_task else [])
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._workers = []
+        self._sweep_task = None
+        
+    def _start_workers(self):
+        """Запуск обработчиков очереди звонков"""
+        if not self._workers:
+            self._workers = [
+                asyncio.create_task(self._worker())
+                for _ in range(self._workers_count)
+            ]
+        
+    async def _worker(self):
+        """Обработка завершённых звонков из очереди"""
+        while True:
+            call_data = await self._call_queue.get()
+            try:
+                await self.processor.process_call(call_data)
+            except Exception as e:
+                logger.error(f"Ошибка обработки звонка {call_data['uniqueid']}: {e}")
+            finally:
+                self._call_queue.task_done()
+        
+    async def _sweep(self):
+        """Удаление каналов, для которых не пришёл Hangup (например, при переподключении AMI)"""
+        while True:
+            await asyncio.sleep(300)
+            cutoff = time.monotonic() - 4 * 3600
+            stale = [
+                uid for uid, call in self.active_channels.items()
+                if call.start_mono < cutoff
+            ]
+            for uid in stale:
+                del self.active_channels[uid]
+            if stale:
+                logger.warning(f"⚠️  Удалено зависших каналов: {len(stale)}, осталось: {len(self.active_channels)}")
+        
     async def on_new_channel(self, manager, event):
         """Новый канал"""
         uniqueid = event.Uniqueid
@@ -461,7 +1049,7 @@ class AsteriskAMIHandler:
         context = event.get("Context", "")
         
         # Детальное логирование
-        if self.config.get("debug", "detailed_ami_logging"):
+        if self._detailed_logging and logger.isEnabledFor(logging.INFO):
             logger.info(f"""
 ╔══════════════════════════════════════
 ║ НОВЫЙ КАНАЛ
@@ -473,52 +1061,51 @@ class AsteriskAMIHandler:
 ║ Context:   {context}
 ╚══════════════════════════════════════""")
         
-        self.active_channels[uniqueid] = {
-            "channel": channel,
-            "callerid": callerid,
-            "exten": exten,
-            "context": context,
-            "start_time": datetime.now(),
-            "direction": self.detect_direction(channel, context),
-            "connected": False
-        }
+        self.active_channels[uniqueid] = ActiveCall(
+            channel=channel,
+            callerid=callerid,
+            exten=exten,
+            context=context,
+            start_time=time.time(),
+            start_mono=time.monotonic(),
+            direction=self.detect_direction(channel, context),
+            is_internal=len(callerid) <= 4
+        )
         
     async def on_bridge_enter(self, manager, event):
         """Канал вошёл в мост"""
         uniqueid = event.Uniqueid
-        if uniqueid in self.active_channels:
-            self.active_channels[uniqueid]["connected"] = True
-            self.active_channels[uniqueid]["answer_time"] = datetime.now()
+        call = self.active_channels.get(uniqueid)
+        if call:
+            call.connected = True
+            call.answer_mono = time.monotonic()
             
     async def on_hangup(self, manager, event):
         """Завершение звонка"""
         uniqueid = event.Uniqueid
-        cause_txt = event.get("Cause-txt", "UNKNOWN")
-        
-        if uniqueid not in self.active_channels:
+        # Большинство Hangup - по каналам, которые мы не отслеживаем
+        call = self.active_channels.pop(uniqueid, None)
+        if call is None:
             return
         
-        call = self.active_channels[uniqueid]
-        end_time = datetime.now()
-        
         # Расчёт длительности
-        if call.get("answer_time"):
-            duration = (end_time - call["answer_time"]).seconds
+        if call.answer_mono is not None:
+            duration = int(time.monotonic() - call.answer_mono)
             status = "ANSWERED"
         else:
             duration = 0
-            status = cause_txt
+            status = event.get("Cause-txt", "UNKNOWN")
         
         # Детальное логирование
-        if self.config.get("debug", "detailed_ami_logging"):
+        if self._detailed_logging and logger.isEnabledFor(logging.INFO):
             logger.info(f"""
 ╔══════════════════════════════════════
 ║ ЗАВЕРШЕНИЕ ЗВОНКА
 ╠══════════════════════════════════════
 ║ UniqueID:   {uniqueid}
-║ CallerID:   {call.get('callerid')}
-║ Exten:      {call.get('exten')}
-║ Direction:  {call.get('direction')}
+║ CallerID:   {call.callerid}
+║ Exten:      {call.exten}
+║ Direction:  {call.direction}
 ║ Duration:   {duration}s
 ║ Status:     {status}
 ╚══════════════════════════════════════""")
@@ -527,67 +1114,63 @@ class AsteriskAMIHandler:
         phone = self.extract_phone(call)
         
         # 🔴 РЕЖИМ ОТЛАДКИ - подмена внутренних номеров
-        if not phone and self.config.get("debug", "process_internal_calls"):
-            test_phone = self.config.get("debug", "test_phone")
-            if test_phone:
-                logger.info(f"⚠️  РЕЖИМ ОТЛАДКИ: Используем тестовый номер {test_phone}")
-                phone = test_phone
+        if not phone and self._process_internal:
+            if self._test_phone:
+                logger.info(f"⚠️  РЕЖИМ ОТЛАДКИ: Используем тестовый номер {self._test_phone}")
+                phone = self._test_phone
             else:
-                logger.warning(f"Внутренний звонок {call.get('callerid')} → {call.get('exten')}, пропускаем")
+                logger.warning(f"Внутренний звонок {call.callerid} → {call.exten}, пропускаем")
         
         if not phone:
             logger.warning(f"Не удалось извлечь номер для {uniqueid}")
-            del self.active_channels[uniqueid]
             return
         
         # Подготовка данных
         call_data = {
             "phone": phone,
-            "direction": call["direction"],
+            "direction": call.direction,
             "duration": duration,
             "status": status,
             "uniqueid": uniqueid,
-            "timestamp": call["start_time"].isoformat(),
-            "internal_call": len(call.get("callerid", "")) <= 4
+            "timestamp": datetime.fromtimestamp(call.start_time).isoformat(),
+            "internal_call": call.is_internal
         }
         
-        # Обработка
-        asyncio.create_task(self.processor.process_call(call_data))
+        # Обработка в пуле; при переполнении очереди звонок не ставится
+        try:
+            self._call_queue.put_nowait(call_data)
+        except asyncio.QueueFull:
+            logger.error(f"❌ Очередь обработки переполнена, звонок {uniqueid} пропущен")
+            return
         
-        del self.active_channels[uniqueid]
         logger.info(f"✓ Звонок отправлен на обработку: {phone}, {duration}с, {status}")
         
     def detect_direction(self, channel: str, context: str = "") -> str:
         """Определение направления"""
-        channel_lower = channel.lower()
-        context_lower = context.lower()
-        
-        if "from-trunk" in channel_lower or "from-pstn" in channel_lower:
-            return "inbound"
-        if "from-trunk" in context_lower or "from-pstn" in context_lower:
-            return "inbound"
-        elif "from-internal" in channel_lower or "from-internal" in context_lower:
-            return "outbound"
-        elif "ext-local" in context_lower:
-            return "internal"
-        
-        return "unknown"
+        # Один проход по каналу и контексту; приоритет:
+        # входящий > исходящий > внутренний
+        direction = "unknown"
+        for m in self._DIR_RE.finditer(f"{channel}\n{context}"):
+            kind = m.lastgroup
+            if kind == "inbound":
+                return "inbound"
+            if kind == "outbound":
+                direction = "outbound"
+            elif direction == "unknown" and m.start() > len(channel):
+                direction = "internal"
+        
+        return direction
     
-    def extract_phone(self, call: Dict) -> Optional[str]:
+    def extract_phone(self, call: ActiveCall) -> Optional[str]:
         """Извлечение номера"""
-        callerid = call.get("callerid", "")
-        phone = ''.join(filter(str.isdigit, callerid))
-        
-        # Нормализация для РФ
-        if phone.startswith("8") and len(phone) == 11:
-            phone = "7" + phone[1:]
-        
-        # Минимум 10 цифр для валидного номера
-        return phone if len(phone) >= 10 else None
+        return _normalize_phone(call.callerid)
 
 
 async def main():
     """Главная функция"""
+    amocrm = None
+    processor = None
+    ami_handler = None
     
     try:
         # Загрузка конфигурации
@@ -596,17 +1179,19 @@ async def main():
         # AmoCRM
         amocrm = AmoCRMAPI(config)
         await amocrm.load_tokens()
+        await amocrm.start()
         
         if not amocrm.access_token:
             logger.warning("="*50)
             logger.warning("⚠️  ТРЕБУЕТСЯ АВТОРИЗАЦИЯ AmoCRM")
-            logger.warning(f"1. Откройте: {await amocrm.get_auth_code_url()}")
+            logger.warning(f"1. Откройте: {amocrm.get_auth_code_url()}")
             logger.warning("2. Авторизуйтесь и скопируйте code")
             logger.warning("3. Откройте: http://your-server:8080/oauth?code=YOUR_CODE")
             logger.warning("="*50)
         
         # Процессор
         processor = CallProcessor(config, amocrm)
+        processor.start_watch()
         
         # Webhook сервер
         webhook = WebhookServer(config, amocrm, processor)
@@ -628,21 +1213,27 @@ async def main():
         logger.info("✓ Интеграция FreePBX + AmoCRM запущена")
         logger.info("="*50)
         
-        while True:
-            await asyncio.sleep(60)
-            
-            # Автообновление токенов каждый час
-            if datetime.now().minute == 0 and amocrm.refresh_token:
-                try:
-                    await amocrm.refresh_tokens()
-                except Exception as e:
-                    logger.error(f"Ошибка обновления токенов: {e}")
-                    
+        # systemd останавливает сервис SIGTERM - без обработчика процесс
+        # завершился бы, не сохранив очередь загрузок и не отправив примечания
+        stop = asyncio.Event()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+        
+        # Токены обновляются в фоне (AmoCRMAPI._refresh_loop)
+        await stop.wait()
+        logger.info("Остановка сервиса...")
+        
     except KeyboardInterrupt:
         logger.info("Остановка сервиса...")
     except Exception as e:
         logger.error(f"Критическая ошибка: {e}", exc_info=True)
         raise
+    finally:
+        if ami_handler:
+            await ami_handler.close()
+        if processor:
+            await processor.stop_watch()
+        if amocrm:
+            await amocrm.close()
 
 
 if __name__ == "__main__":
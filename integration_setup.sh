@@ -21,7 +21,7 @@ source venv/bin/activate
 
 # 5. Установка Python пакетов
 pip install --upgrade pip
-pip install aiohttp panoramisk redis
+pip install aiohttp orjson panoramisk redis
 
 # 6. Создание конфигурационного файла
 cat > /opt/freepbx-amocrm/config.json <<'EOF'